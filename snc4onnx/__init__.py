@@ -1,3 +1,3 @@
-from snc4onnx.onnx_network_combine import combine, main
+from snc4onnx.onnx_network_combine import combine, main, CombineError
 
 __version__ = '1.0.13'
@@ -3,14 +3,21 @@
 import os
 import re
 import sys
+import stat
+import shutil
+import hashlib
+import gc
+import mmap
+import logging
+import tempfile
 import traceback
 import collections
 import itertools
 from argparse import ArgumentParser
+from concurrent.futures import Future, ThreadPoolExecutor
 import onnx
 import onnx_graphsurgeon as gs
-from onnxsim import simplify
-from typing import Optional, List
+from typing import Optional, List, Tuple, Union
 
 
 class Color:
@@ -38,12 +45,673 @@ class Color:
     BG_DEFAULT     = '\033[49m'
     RESET          = '\033[0m'
 
+
+def _use_color(stream) -> bool:
+    """
+    Escape sequences are only meaningful on a terminal,\n\
+    so they are left out when the stream is piped to a file or a CI log,\n\
+    or when the user opted out with the NO_COLOR convention (https://no-color.org).
+    """
+    return stream is not None \
+        and stream.isatty() \
+        and not os.environ.get('NO_COLOR', '')
+
+
+class _ColorFormatter(logging.Formatter):
+    LEVEL_COLORS = {
+        logging.DEBUG: Color.BLUE,
+        logging.INFO: Color.GREEN,
+        logging.WARNING: Color.YELLOW,
+        logging.ERROR: Color.RED,
+        logging.CRITICAL: Color.RED,
+    }
+
+    def __init__(self, use_color: bool):
+        super().__init__()
+        # 'INFO: ' etc. composed once instead of on every record.
+        # Colors are decided per handler, since stdout and stderr may be redirected separately.
+        self.level_prefixes = {
+            level: \
+                f'{color}{logging.getLevelName(level)}:{Color.RESET} ' \
+                    if use_color else f'{logging.getLevelName(level)}: '
+            for level, color in self.LEVEL_COLORS.items()
+        }
+
+    def format(self, record: logging.LogRecord) -> str:
+        prefix = self.level_prefixes.get(record.levelno)
+        if prefix is None:
+            prefix = f'{record.levelname}: '
+        return prefix + record.getMessage()
+
+
+class _CallLogger(logging.LoggerAdapter):
+    """
+    Logger of a single combine call.\n\
+    non_verbose only applies to the call it was passed to,\n\
+    and the level of the 'snc4onnx' logger is left to the application.
+    """
+    def __init__(self, logger: logging.Logger, min_level: int):
+        super().__init__(logger, {})
+        self.min_level = min_level
+
+    def isEnabledFor(self, level: int) -> bool:
+        return level >= self.min_level and self.logger.isEnabledFor(level)
+
+
+# INFO goes to stdout. WARNING and above go to stderr, so that they survive redirecting the logs.
+# The handlers are attached only once, even when the module is imported again,
+# e.g. as __main__ by "python -m snc4onnx.onnx_network_combine" or by importlib.reload.
+logger = logging.getLogger('snc4onnx')
+if not logger.handlers:
+    _log_handler = logging.StreamHandler(sys.stdout)
+    _log_handler.setFormatter(_ColorFormatter(use_color=_use_color(sys.stdout)))
+    _log_handler.addFilter(lambda record: record.levelno < logging.WARNING)
+    logger.addHandler(_log_handler)
+    _error_log_handler = logging.StreamHandler(sys.stderr)
+    _error_log_handler.setFormatter(_ColorFormatter(use_color=_use_color(sys.stderr)))
+    _error_log_handler.setLevel(logging.WARNING)
+    logger.addHandler(_error_log_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+class CombineError(RuntimeError):
+    """
+    Raised by combine when the models cannot be combined with the given arguments.
+    """
+    pass
+
+
+SIMPLIFY_BACKENDS = [
+    'onnxsim',
+    'onnxruntime',
+    'shape_inference',
+]
+
 ONNX_STANDARD_DOMAINS = [
     'ai.onnx',
     'ai.onnx.ml',
     '',
 ]
 
+# Maximum size of a single serialized protobuf message
+PROTOBUF_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
+# Number of combined models kept in cache_dir. The least recently used ones are removed.
+CACHE_MAX_ENTRIES = 16
+
+# Serialized key of the "location" entry that every external data tensor has
+# (StringStringEntryProto field 1, length 8)
+EXTERNAL_DATA_LOCATION_MARKER = b'\x0a\x08location'
+
+# Only files named like this are cache entries, and only they are ever evicted
+CACHE_ENTRY_FILE_NAME_PATTERN = re.compile(r'[0-9a-f]{64}\.onnx')
+
+
+def _save_as_external_data(
+    model: onnx.ModelProto,
+    output_onnx_file_path: str,
+) -> None:
+    """
+    Save the model with all tensors of 1KB or more in a single "<file name>.data" file.\n\
+    onnx.save strips raw_data from the tensors it moves out of the ModelProto,\n\
+    so the weights are read back afterwards and the caller's model stays complete.
+    """
+    output_dir = os.path.dirname(output_onnx_file_path)
+    external_data_file_name = f'{os.path.basename(output_onnx_file_path)}.data'
+    # onnx appends to an existing data file, so a previous run's weights would be left in it
+    try:
+        os.remove(os.path.join(output_dir, external_data_file_name))
+    except FileNotFoundError:
+        pass
+    onnx.save(
+        model,
+        output_onnx_file_path,
+        save_as_external_data=True,
+        all_tensors_to_one_file=True,
+        location=external_data_file_name,
+        size_threshold=1024,
+    )
+    onnx.external_data_helper.load_external_data_for_model(model, output_dir)
+
+
+def _load_onnx_graph_structure(
+    input_onnx_file_path: str,
+) -> onnx.ModelProto:
+    """
+    Load only the graph structure of an onnx file and leave its external data on disk.\n\
+    Each external tensor remembers the directory of its data file in a "basepath" entry,\n\
+    because the tensors of several models end up in one graph.\n\
+    The weights are read later by _load_external_data.
+    """
+    onnx_graph = onnx.load(input_onnx_file_path, load_external_data=False)
+    base_dir = os.path.dirname(os.path.abspath(input_onnx_file_path))
+    for tensor in onnx.external_data_helper._get_all_tensors(onnx_graph):
+        if onnx.external_data_helper.uses_external_data(tensor):
+            entry = tensor.external_data.add()
+            entry.key = 'basepath'
+            entry.value = base_dir
+    return onnx_graph
+
+
+def _load_external_data(
+    model: onnx.ModelProto,
+) -> None:
+    """
+    Read the weights of all tensors loaded by _load_onnx_graph_structure into the model.\n\
+    Each data file is opened and memory-mapped once, however many tensors it holds.
+    """
+    tensors_by_data_file = collections.defaultdict(list)
+    for tensor in onnx.external_data_helper._get_all_tensors(model):
+        if onnx.external_data_helper.uses_external_data(tensor):
+            info = onnx.external_data_helper.ExternalDataInfo(tensor)
+            # The location comes from the model file, so it must not point outside its directory
+            base_dir = os.path.realpath(info.basepath)
+            data_file_path = os.path.realpath(os.path.join(base_dir, info.location))
+            if os.path.isabs(info.location) \
+                or os.path.commonpath([base_dir, data_file_path]) != base_dir:
+                raise CombineError(
+                    f'The external data of a tensor is outside the directory of its model. ' +
+                    f'tensor: {tensor.name} location: {info.location}'
+                )
+            tensors_by_data_file[data_file_path].append((tensor, info))
+
+    for data_file_path, tensors in tensors_by_data_file.items():
+        with open(data_file_path, 'rb') as f:
+            data_file_size = os.fstat(f.fileno()).st_size
+            # An empty file cannot be mapped, and only holds empty tensors anyway
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if data_file_size > 0 else b''
+            try:
+                for tensor, info in tensors:
+                    offset = info.offset or 0
+                    length = info.length if info.length is not None else data_file_size - offset
+                    if offset + length > data_file_size:
+                        raise CombineError(
+                            f'The external data of a tensor exceeds the size of its data file. ' +
+                            f'tensor: {tensor.name} file: {data_file_path}'
+                        )
+                    tensor.raw_data = data[offset:offset+length]
+                    tensor.data_location = onnx.TensorProto.DEFAULT
+                    del tensor.external_data[:]
+            finally:
+                if data_file_size > 0:
+                    data.close()
+
+
+def _remove_prefix(
+    name: str,
+    prefix: str,
+) -> str:
+    """
+    Remove prefix from the beginning of name, if present.\n\
+    Equivalent to str.removeprefix, which is not available before Python 3.9.
+    """
+    if prefix and name.startswith(prefix):
+        return name[len(prefix):]
+    return name
+
+
+def _is_toposorted(
+    gs_graph: gs.Graph,
+) -> bool:
+    """
+    Check whether every node comes after the nodes producing its inputs.\n\
+    Graphs with subgraphs or local functions are reported as unsorted,\n\
+    so that toposort handles them.
+    """
+    if gs_graph.functions:
+        return False
+    visited_node_ids = set()
+    for graph_node in gs_graph.nodes:
+        for _ in graph_node.subgraphs():
+            return False
+        for graph_node_input in graph_node.inputs:
+            for producer_node in graph_node_input.inputs:
+                if id(producer_node) not in visited_node_ids:
+                    return False
+        visited_node_ids.add(id(graph_node))
+    return True
+
+
+def _apply_prefix_inplace(
+    gs_graph: gs.Graph,
+    prefix: str,
+) -> None:
+    """
+    Add prefix to the names of all nodes, tensors and local functions of the graph and its subgraphs,\n\
+    like onnx.compose.add_prefix does for a ModelProto. Empty names are not prefixed.
+    """
+    # Subgraphs share the tensor objects they read from the outer graph
+    renamed_tensor_ids = set()
+
+    def apply_prefix(graph: gs.Graph) -> None:
+        for tensor in itertools.chain(
+            graph.inputs,
+            graph.outputs,
+            *(graph_node.inputs for graph_node in graph.nodes),
+            *(graph_node.outputs for graph_node in graph.nodes),
+        ):
+            if tensor.name and id(tensor) not in renamed_tensor_ids:
+                tensor.name = f'{prefix}{tensor.name}'
+                renamed_tensor_ids.add(id(tensor))
+        for graph_node in graph.nodes:
+            if graph_node.name:
+                graph_node.name = f'{prefix}{graph_node.name}'
+            for subgraph in graph_node.subgraphs():
+                apply_prefix(subgraph)
+
+    apply_prefix(gs_graph)
+
+    # Local functions are renamed together with the nodes calling them
+    if gs_graph.functions:
+        function_names = {}
+        for function in gs_graph.functions:
+            function_names[function.name] = f'{prefix}{function.name}'
+            function.name = function_names[function.name]
+        for graph in [gs_graph, *gs_graph.functions]:
+            for graph_node in graph.nodes:
+                if graph_node.op in function_names:
+                    graph_node.op = function_names[graph_node.op]
+
+
+def _cleanup_onnx_graph(
+    onnx_graph: onnx.ModelProto,
+) -> gs.Graph:
+    """
+    Remove unused nodes and tensors from the model and sort its nodes topologically.
+    """
+    gs_graph = gs.import_onnx(onnx_graph)
+    gs_graph.cleanup()
+    # Most exporters already emit the nodes in topological order
+    if not _is_toposorted(gs_graph):
+        gs_graph.toposort()
+    return gs_graph
+
+
+def _optimize_with_onnxruntime(
+    model: onnx.ModelProto,
+) -> onnx.ModelProto:
+    """
+    Constant folding and redundant node elimination with onnxruntime's basic graph optimizations.\n\
+    Unlike onnxsim, this runs entirely in C++ without executing the graph.
+    """
+    import onnxruntime as ort
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_onnx_file_path = os.path.join(tmp_dir, 'combined.onnx')
+        optimized_onnx_file_path = os.path.join(tmp_dir, 'optimized.onnx')
+        _write_onnx(model, input_onnx_file_path)
+        sess_options = ort.SessionOptions()
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_BASIC
+        sess_options.optimized_model_filepath = optimized_onnx_file_path
+        ort.InferenceSession(
+            input_onnx_file_path,
+            sess_options,
+            providers=['CPUExecutionProvider'],
+        )
+        return onnx.load(optimized_onnx_file_path)
+
+
+def _simplify(
+    model: onnx.ModelProto,
+    simplify_backend: str,
+) -> onnx.ModelProto:
+    """
+    Optimize the model with the backend selected by simplify_backend.
+    """
+    if simplify_backend == 'onnxruntime':
+        return _optimize_with_onnxruntime(model)
+    # onnx shape inference serializes the whole model, which is not possible beyond 2GB
+    exceeds_protobuf_max_size = model.ByteSize() > PROTOBUF_MAX_SIZE
+    if simplify_backend == 'shape_inference':
+        if exceeds_protobuf_max_size:
+            return model
+        return onnx.shape_inference.infer_shapes(model)
+    # Imported here so that runs with disable_onnxsim do not pay for loading onnxsim
+    from onnxsim import simplify
+    simplified_model, check = simplify(
+        model,
+        skip_shape_inference=exceeds_protobuf_max_size,
+    )
+    return simplified_model
+
+
+def _write_onnx(
+    model: onnx.ModelProto,
+    output_onnx_file_path: str,
+) -> None:
+    """
+    Serialize the model straight to a file.\n\
+    Falls back to external data when the model does not fit in a single protobuf.
+    """
+    if model.ByteSize() > PROTOBUF_MAX_SIZE:
+        _save_as_external_data(model, output_onnx_file_path)
+        return
+    _write_serialized(model.SerializeToString(), output_onnx_file_path)
+
+
+def _write_serialized(
+    serialized_model: bytes,
+    output_onnx_file_path: str,
+) -> None:
+    """
+    Write an already serialized model to a file.
+    """
+    with open(output_onnx_file_path, 'wb') as f:
+        f.write(serialized_model)
+
+
+def _write_fusion_model_with_external_data(
+    fusion_model: onnx.ModelProto,
+    output_onnx_file_path: str,
+) -> None:
+    """
+    Load the external data of a model owned by the caller into it and write it out.
+    """
+    _load_external_data(fusion_model)
+    _write_onnx(fusion_model, output_onnx_file_path)
+
+
+def _cache_key(
+    input_onnx_file_paths: List[str],
+    options: tuple,
+) -> str:
+    """
+    SHA-256 over the contents of all input onnx files, the external data files they reference,\n\
+    the combine options and the snc4onnx version.
+    """
+    from snc4onnx import __version__
+
+    def update_with_file(file_path: str, marker: bytes = b'') -> bool:
+        # Returns whether marker appears in the file, also across chunk boundaries
+        found = False
+        tail = b''
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(chunk)
+                if marker and not found:
+                    found = marker in tail + chunk
+                    tail = chunk[-(len(marker) - 1):]
+        return found
+
+    sha256 = hashlib.sha256()
+    for input_onnx_file_path in input_onnx_file_paths:
+        # The weights of large models live in external data files, so they are part of the key too.
+        # Their locations are "location" entries of the tensors, so the model is only parsed
+        # to find them when that key appears in its bytes at all.
+        if not update_with_file(input_onnx_file_path, EXTERNAL_DATA_LOCATION_MARKER):
+            continue
+        onnx_graph = onnx.load(input_onnx_file_path, load_external_data=False)
+        external_data_locations = sorted(
+            set(
+                onnx.external_data_helper.ExternalDataInfo(tensor).location \
+                    for tensor in onnx.external_data_helper._get_all_tensors(onnx_graph) \
+                        if onnx.external_data_helper.uses_external_data(tensor)
+            )
+        )
+        del onnx_graph
+        base_dir = os.path.dirname(os.path.abspath(input_onnx_file_path))
+        for location in external_data_locations:
+            sha256.update(location.encode('utf-8'))
+            update_with_file(os.path.join(base_dir, location))
+    sha256.update(repr((__version__, options)).encode('utf-8'))
+    return sha256.hexdigest()
+
+
+def _store_in_cache(
+    output_onnx_file_path: str,
+    cached_onnx_file_path: str,
+) -> None:
+    """
+    Copy the combined model into the cache and drop the least recently used entries.
+    """
+    def last_access_time(file_path: str) -> float:
+        # A concurrent run may have evicted the file in the meantime
+        try:
+            return os.path.getatime(file_path)
+        except OSError:
+            return 0.0
+
+    cache_dir = os.path.dirname(cached_onnx_file_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Copy under a temporary name first so that a concurrent run never reads a partial file
+    tmp_cached_onnx_file_path = f'{cached_onnx_file_path}.{os.getpid()}.tmp'
+    shutil.copyfile(output_onnx_file_path, tmp_cached_onnx_file_path)
+    os.replace(tmp_cached_onnx_file_path, cached_onnx_file_path)
+
+    # cache_dir may be shared with other files, which must never be evicted
+    cached_onnx_file_paths = [
+        os.path.join(cache_dir, file_name) \
+            for file_name in os.listdir(cache_dir) \
+                if CACHE_ENTRY_FILE_NAME_PATTERN.fullmatch(file_name)
+    ]
+    cached_onnx_file_paths.sort(key=last_access_time, reverse=True)
+    for stale_onnx_file_path in cached_onnx_file_paths[CACHE_MAX_ENTRIES:]:
+        try:
+            os.remove(stale_onnx_file_path)
+        except OSError:
+            pass
+
+
+def _merge_two(
+    src_gs_model: gs.Graph,
+    dest_gs_model: gs.Graph,
+    io_map: List[Tuple[str, str]],
+    check_duplicate_op_names: bool,
+) -> bool:
+    """
+    Merge dest_gs_model into src_gs_model in place, connecting each srcop of io_map to its destop.\n\
+    Returns True when nodes that already were in src_gs_model got new inputs,\n\
+    which is the only way a merge can break the topological order of the nodes.
+    """
+    # Merging Domain Lists
+    src_gs_model_domains: List[onnx.OperatorSetIdProto] = src_gs_model.import_domains
+    dest_gs_model_domains: List[onnx.OperatorSetIdProto] = dest_gs_model.import_domains
+    merged_gs_model_domains: List[onnx.OperatorSetIdProto] = src_gs_model_domains
+    distinct_dest_gs_model_domains = [
+        domain \
+            for domain in dest_gs_model_domains \
+                if domain not in merged_gs_model_domains
+    ]
+    for domain in distinct_dest_gs_model_domains:
+        merged_gs_model_domains.append(domain)
+    src_gs_model.import_domains = merged_gs_model_domains
+
+    # Duplicate OP name check
+    # Names with different prefixes can only collide when one prefix starts with another
+    # (e.g. "a_" and "a_b_"), so the check is skipped when the prefixes rule that out.
+    # Set SNC4ONNX_CHECK_DUP=1 to always run it.
+    if check_duplicate_op_names:
+        # Only names that appear in both models can collide by merging them
+        src_op_names = set(
+            itertools.chain(
+                (graph_node.name for graph_node in src_gs_model.nodes),
+                (graph_input.name for graph_input in src_gs_model.inputs),
+                (graph_output.name for graph_output in src_gs_model.outputs),
+            )
+        )
+        dest_op_names = set(
+            itertools.chain(
+                (graph_node.name for graph_node in dest_gs_model.nodes),
+                (graph_input.name for graph_input in dest_gs_model.inputs),
+                (graph_output.name for graph_output in dest_gs_model.outputs),
+            )
+        )
+        dup_msg = ', '.join(
+            f'op_name:{op_name}' \
+                for op_name in sorted(src_op_names & dest_op_names)
+        )
+        if dup_msg:
+            raise CombineError(
+                f'\nThere is a duplicate OP name after merging models.\n' +
+                f'{dup_msg}\n' +
+                f'Avoid duplicate OP names by specifying a prefix in op_prefixes_after_merging.'
+            )
+
+    # Transfer all INPUTs, Nodes and OUTPUTs of dest_gs_model to src_gs_model
+    dest_gs_model_node_ids = set(id(dest_gs_model_node) for dest_gs_model_node in dest_gs_model.nodes)
+    ## INPUTs
+    src_gs_model.inputs.extend(dest_gs_model.inputs)
+    ## Nodes
+    src_gs_model.nodes.extend(dest_gs_model.nodes)
+    ## OUTPUTs
+    src_gs_model.outputs.extend(dest_gs_model.outputs)
+
+    # If the OP specified as srcop in io_map_srcop_destop is a graph INPUT,
+    # use onnx_graphsurgeon to merge
+    # Otherwise, use onnx.compose.merge_models for simple merging
+    # Look up the tensors and their consumers by name,
+    # instead of scanning every node for every srcop/destop pair.
+    src_gs_model_inputs = {
+        src_gs_model_input.name: src_gs_model_input \
+            for src_gs_model_input in src_gs_model.inputs
+    }
+    src_gs_model_node_outputs = {}
+    src_gs_model_input_consumers = collections.defaultdict(list)
+    for src_gs_model_node in src_gs_model.nodes:
+        for inp_idx, src_gs_model_node_input in enumerate(src_gs_model_node.inputs):
+            src_gs_model_input_consumers[src_gs_model_node_input.name].append((src_gs_model_node, inp_idx))
+        for src_gs_model_node_output in src_gs_model_node.outputs:
+            src_gs_model_node_outputs.setdefault(src_gs_model_node_output.name, src_gs_model_node_output)
+    # Graph OUTPUTs that now feed the dest model. They are removed together after rewiring.
+    src_gs_model_outputs_to_drop = set()
+    src_nodes_rewired = False
+
+    for srcop_name, destop_name in io_map:
+        # Split processing if srcop_name is included or not included in the graph INPUT
+        if srcop_name in src_gs_model_inputs:
+            # Overwrite srcop with destop if srcop_name is included in the graph INPUT
+            src_output = src_gs_model_inputs[srcop_name]
+        else:
+            src_output = src_gs_model_node_outputs.get(srcop_name, None)
+            if src_output is None:
+                continue
+        # The rewired consumers now read src_output, so they move to its name
+        consumers = src_gs_model_input_consumers.pop(destop_name, [])
+        for src_gs_model_node, inp_idx in consumers:
+            src_gs_model_node.inputs[inp_idx] = src_output
+            # A src node may now read a tensor produced after it
+            if id(src_gs_model_node) not in dest_gs_model_node_ids:
+                src_nodes_rewired = True
+        src_gs_model_input_consumers[src_output.name].extend(consumers)
+        # Delete from the graph OUTPUT if the Node was specified as the OUTPUT of the graph.
+        if consumers and srcop_name not in src_gs_model_inputs:
+            src_gs_model_outputs_to_drop.add(src_output.name)
+
+    if src_gs_model_outputs_to_drop:
+        src_gs_model.outputs = [
+            src_gs_model_output \
+                for src_gs_model_output in src_gs_model.outputs \
+                    if src_gs_model_output.name not in src_gs_model_outputs_to_drop
+        ]
+
+    # Delete unused INPUTs
+    # The consumer map above is kept up to date by the rewiring, so it tells which are still read
+    src_gs_model.inputs = [
+        src_gs_model_input \
+            for src_gs_model_input in src_gs_model.inputs \
+                if src_gs_model_input_consumers.get(src_gs_model_input.name)
+    ]
+
+    return src_nodes_rewired
+
+
+def _validate_inputs(
+    srcop_destop: List[str],
+    op_prefixes_after_merging: List[str],
+    input_onnx_file_paths: List[str],
+    onnx_graphs: List[onnx.ModelProto],
+    simplify_backend: str,
+) -> None:
+    """
+    Check the arguments of combine without loading any model.\n\
+    All problems found are raised together as the args of a single ValueError.
+    """
+    # One of input_onnx_file_paths or onnx_graphs must be specified
+    if len(input_onnx_file_paths) == 0 and len(onnx_graphs) == 0:
+        raise ValueError(
+            f'Either input_onnx_file_paths or onnx_graphs must be specified.'
+        )
+
+    # onnx_graphs check or input_onnx_file_paths check
+    # Every problem found is reported together before exiting
+    error_messages = []
+
+    if len(onnx_graphs) > 0:
+        # onnx_graphs
+        if len(onnx_graphs) == 1:
+            error_messages.append(
+                f'At least two onnx graphs must be specified.'
+            )
+
+        # Match check between number of onnx_graphs and number of prefixes
+        if op_prefixes_after_merging and len(onnx_graphs) != len(op_prefixes_after_merging):
+            error_messages.append(
+                f'The number of onnx_graphs must match the number of op_prefixes_after_merging.'
+            )
+
+        # onnx x2 -> srcop_destop x1
+        # onnx x3 -> srcop_destop x2
+        # onnx x4 -> srcop_destop x3
+        if len(onnx_graphs) - 1 != len(srcop_destop):
+            error_messages.append(
+                f'The number of srcop_destops must be (number of onnx_graphs - 1).'
+            )
+
+    else:
+        # input_onnx_file_paths
+        if len(input_onnx_file_paths) == 1:
+            error_messages.append(
+                f'At least two input onnx file paths must be specified.'
+            )
+
+        # file existence check
+        # The extension is checked first so that a single os.stat is the only syscall per file.
+        for input_onnx_file_path in input_onnx_file_paths:
+            is_onnx_file = os.path.splitext(input_onnx_file_path)[-1] == '.onnx'
+            if is_onnx_file:
+                try:
+                    is_onnx_file = stat.S_ISREG(os.stat(input_onnx_file_path).st_mode)
+                except OSError:
+                    is_onnx_file = False
+            if not is_onnx_file:
+                error_messages.append(
+                    f'The specified file (.onnx) does not exist. or not an onnx file. File: {input_onnx_file_path}'
+                )
+
+        # Match check between number of onnx files and number of prefixes
+        if op_prefixes_after_merging and len(input_onnx_file_paths) != len(op_prefixes_after_merging):
+            error_messages.append(
+                f'The number of input_onnx_file_paths must match the number of op_prefixes_after_merging.'
+            )
+
+        # onnx x2 -> srcop_destop x1
+        # onnx x3 -> srcop_destop x2
+        # onnx x4 -> srcop_destop x3
+        if len(input_onnx_file_paths) - 1 != len(srcop_destop):
+            error_messages.append(
+                f'The number of srcop_destops must be (number of input_onnx_file_paths - 1).'
+            )
+
+    # Duplicate prefix check
+    if op_prefixes_after_merging and len(set(op_prefixes_after_merging)) != len(op_prefixes_after_merging):
+        duplicate_prefixes = [
+            op_prefix \
+                for op_prefix, count in collections.Counter(op_prefixes_after_merging).items() \
+                    if count > 1
+        ]
+        error_messages.append(
+            f'Duplicate values cannot be specified for op_prefixes_after_merging. ' +
+            f'Duplicates: {duplicate_prefixes}'
+        )
+
+    if simplify_backend not in SIMPLIFY_BACKENDS:
+        error_messages.append(
+            f'simplify_backend must be one of {SIMPLIFY_BACKENDS}. simplify_backend: {simplify_backend}'
+        )
+
+    if error_messages:
+        raise ValueError(*error_messages)
+
 
 def combine(
     srcop_destop: List[str],
@@ -54,6 +722,12 @@ def combine(
     output_of_onnx_file_in_the_process_of_fusion: Optional[bool] = False,
     disable_onnxsim: Optional[bool] = False,
     non_verbose: Optional[bool] = False,
+    output_as_external_data: Optional[bool] = False,
+    disable_external_data_load: Optional[bool] = False,
+    cleanup_input_graphs: Optional[bool] = False,
+    cache_dir: Optional[str] = '',
+    simplify_backend: Optional[str] = 'onnxsim',
+    simplify_between_merges: Optional[bool] = False,
 ) -> onnx.ModelProto:
     """
     Parameters
@@ -114,197 +788,260 @@ def combine(
 
     disable_onnxsim: Optional[bool]
         Suppress the execution of onnxsim on the backend and dare to leave redundant processing.\n\
+        Also suppresses the onnxruntime and shape_inference backends of simplify_backend.\n\
         Default: False
 
     non_verbose: Optional[bool]
         Do not show all information logs. Only error logs are displayed.\n\
         Default: False
 
+    output_as_external_data: Optional[bool]
+        Save the weights of the combined model in an external data file\n\
+        ("<output_onnx_file_path>.data") instead of inside the .onnx file.\n\
+        Models exceeding the 2GB protobuf limit are always saved this way.\n\
+        Default: False
+
+    disable_external_data_load: Optional[bool]
+        Do not read the external data (weights) of input_onnx_file_paths while merging.\n\
+        The models are merged on their graph structure only and the weights are read\n\
+        just once, after merging, from the original external data files.\n\
+        Reduces the peak memory when combining large models stored with external data.\n\
+        Ignored for onnx_graphs.\n\
+        Default: False
+
+    cleanup_input_graphs: Optional[bool]
+        Remove unused nodes from each input model and sort it topologically before merging.\n\
+        The merged graph is always cleaned up, so this is only needed when an input model\n\
+        contains dead nodes whose names collide with OP names of another model.\n\
+        Default: False
+
+    cache_dir: Optional[str]
+        Directory in which combined models are cached.\n\
+        The cache key is the SHA-256 of the contents of input_onnx_file_paths,\n\
+        the external data files they reference, the options and the snc4onnx version,\n\
+        so running the same combination again just copies the cached file to output_onnx_file_path.\n\
+        Only used with input_onnx_file_paths and output_onnx_file_path, and not together with\n\
+        output_of_onnx_file_in_the_process_of_fusion or output_as_external_data.\n\
+        If not specified, no cache is used.\n\
+        Default: ''
+
+    simplify_backend: Optional[str]
+        Backend used to optimize the combined model. "onnxsim", "onnxruntime" or "shape_inference".\n\
+        "onnxruntime" applies only the basic graph optimizations of onnxruntime\n\
+        (constant folding, redundant node elimination), which needs much less time and memory\n\
+        than onnxsim on large models. onnxruntime must be installed.\n\
+        "shape_inference" only runs onnx shape inference over the combined model.\n\
+        This is enough when every input model has already been simplified,\n\
+        since merging itself leaves nothing to fold.\n\
+        Default: 'onnxsim'
+
+    simplify_between_merges: Optional[bool]
+        When combining three or more models, also optimize each intermediate fusion result\n\
+        with simplify_backend, so that the following merges work on a smaller graph.\n\
+        The OP names specified in the following srcop_destop must survive the optimization.\n\
+        Has no effect together with disable_external_data_load.\n\
+        Default: False
+
     Returns
     -------
     combined_graph: onnx.ModelProto
         Combined onnx ModelProto
+
+    Raises
+    ------
+    CombineError
+        Invalid arguments or input models that cannot be combined.\n\
+        Each element of args is one error message.
     """
 
-    # One of input_onnx_file_paths or onnx_graphs must be specified
-    if len(input_onnx_file_paths) == 0 and len(onnx_graphs) == 0:
-        print(
-            f'{Color.RED}ERROR:{Color.RESET} '+
-            f'Either input_onnx_file_paths or onnx_graphs must be specified.'
-        )
-        sys.exit(1)
+    # non_verbose only keeps the error logs of this call.
+    # Filtered records are dropped before their message is formatted.
+    log = _CallLogger(logger, logging.ERROR if non_verbose else logging.INFO)
 
-    # onnx_graphs check or input_onnx_file_paths check
     if not op_prefixes_after_merging:
         op_prefixes_after_merging = []
 
-    if len(onnx_graphs) > 0:
-        # onnx_graphs
-        if len(onnx_graphs) == 1:
-            print(
-                f'{Color.RED}ERROR:{Color.RESET} '+
-                f'At least two onnx graphs must be specified.'
-            )
-            sys.exit(1)
-
-        # Match check between number of onnx_graphs and number of prefixes
-        if op_prefixes_after_merging and len(onnx_graphs) != len(op_prefixes_after_merging):
-            print(
-                f'{Color.RED}ERROR:{Color.RESET} '+
-                f'The number of onnx_graphs must match the number of op_prefixes_after_merging.'
-            )
-            sys.exit(1)
-
-        # onnx x2 -> srcop_destop x1
-        # onnx x3 -> srcop_destop x2
-        # onnx x4 -> srcop_destop x3
-        if len(onnx_graphs) - 1 != len(srcop_destop):
-            print(
-                f'{Color.RED}ERROR:{Color.RESET} '+
-                f'The number of srcop_destops must be (number of onnx_graphs - 1).'
-            )
-            sys.exit(1)
-
-    else:
-        # input_onnx_file_paths
-        if len(input_onnx_file_paths) == 1:
-            print(
-                f'{Color.RED}ERROR:{Color.RESET} '+
-                f'At least two input onnx file paths must be specified.'
-            )
-            sys.exit(1)
+    # All cheap argument checks run before any model is loaded.
+    try:
+        _validate_inputs(
+            srcop_destop,
+            op_prefixes_after_merging,
+            input_onnx_file_paths,
+            onnx_graphs,
+            simplify_backend,
+        )
+    except ValueError as e:
+        raise CombineError(*e.args) from e
 
-        # file existence check
+    # MODEL_INDX print - only input_onnx_file_paths
+    # The prefixes are either empty or as many as the files after the validation above
+    if len(onnx_graphs) == 0 and log.isEnabledFor(logging.INFO):
         for idx, input_onnx_file_path in enumerate(input_onnx_file_paths):
-            if not os.path.exists(input_onnx_file_path) or \
-                not os.path.isfile(input_onnx_file_path) or \
-                not os.path.splitext(input_onnx_file_path)[-1] == '.onnx':
-                print(
-                    f'{Color.RED}ERROR:{Color.RESET} '+
-                    f'The specified file (.onnx) does not exist. or not an onnx file. File: {input_onnx_file_path}'
+            if op_prefixes_after_merging:
+                log.info(
+                    'MODEL_INDX=%d: %s, prefix="%s"',
+                    idx+1, input_onnx_file_path, op_prefixes_after_merging[idx],
                 )
-                sys.exit(1)
+            else:
+                log.info('MODEL_INDX=%d: %s', idx+1, input_onnx_file_path)
 
-        # Match check between number of onnx files and number of prefixes
-        if op_prefixes_after_merging and len(input_onnx_file_paths) != len(op_prefixes_after_merging):
-            print(
-                f'{Color.RED}ERROR:{Color.RESET} '+
-                f'The number of input_onnx_file_paths must match the number of op_prefixes_after_merging.'
-            )
-            sys.exit(1)
+    # Without their external data the intermediate models cannot be constant folded,
+    # so simplify_between_merges is dropped in 3.
+    if simplify_between_merges and disable_external_data_load and len(onnx_graphs) == 0:
+        log.warning(
+            'simplify_between_merges has no effect together with disable_external_data_load. '+
+            'Only the combined model is optimized.'
+        )
 
-        # onnx x2 -> srcop_destop x1
-        # onnx x3 -> srcop_destop x2
-        # onnx x4 -> srcop_destop x3
-        if len(input_onnx_file_paths) - 1 != len(srcop_destop):
-            print(
-                f'{Color.RED}ERROR:{Color.RESET} '+
-                f'The number of srcop_destops must be (number of input_onnx_file_paths - 1).'
-            )
-            sys.exit(1)
+    # Reuse a previously combined model
+    cached_onnx_file_path = ''
+    if cache_dir \
+        and len(onnx_graphs) == 0 \
+        and output_onnx_file_path \
+        and not output_of_onnx_file_in_the_process_of_fusion \
+        and not output_as_external_data:
 
-    # Duplicate prefix check
-    def has_duplicates(seq):
-        seen = []
-        unique_list = [x for x in seq if x not in seen and not seen.append(x)]
-        return len(seq) != len(unique_list)
-
-    if op_prefixes_after_merging and has_duplicates(op_prefixes_after_merging):
-        print(
-            f'{Color.RED}ERROR:{Color.RESET} '+
-            f'Duplicate values cannot be specified for op_prefixes_after_merging.'
+        cache_key = _cache_key(
+            input_onnx_file_paths,
+            (
+                srcop_destop,
+                op_prefixes_after_merging,
+                disable_onnxsim,
+                simplify_backend,
+                simplify_between_merges,
+                cleanup_input_graphs,
+            ),
         )
-        sys.exit(1)
-
-    # MODEL_INDX print - only input_onnx_file_paths
-    if len(onnx_graphs) == 0:
-        for idx, (input_onnx_file_path, op_prefix_after_merging) in \
-            enumerate(itertools.zip_longest(input_onnx_file_paths, op_prefixes_after_merging)):
-            if not non_verbose:
-                print(
-                    f'{Color.GREEN}INFO:{Color.RESET} '+
-                    f'MODEL_INDX={idx+1}: {input_onnx_file_path}, prefix="{op_prefix_after_merging}"'
-                )
+        cached_onnx_file_path = os.path.join(cache_dir, f'{cache_key}.onnx')
+        if os.path.isfile(cached_onnx_file_path):
+            shutil.copyfile(cached_onnx_file_path, output_onnx_file_path)
+            # Mark as recently used for the eviction in _store_in_cache
+            os.utime(cached_onnx_file_path)
+            log.info('Reused the cached combined model. File: %s', cached_onnx_file_path)
+            log.info('Finish!')
+            return onnx.load(output_onnx_file_path)
 
     # Combine
     ## 1. ONNX load
+    # Only the names and domains of custom domain nodes are kept.
+    # Holding the NodeProtos themselves would keep every input model alive until the end.
+    # tmp_onnx_graphs holds the imported graph-surgeon graphs.
     tmp_onnx_graphs = []
-    custom_domain_check_onnx_nodes = []
+    custom_domains = {}
     max_ir_version: int = 0
-    if len(onnx_graphs) > 0:
-        for onnx_graph in onnx_graphs:
-            domain: str = onnx_graph.domain
-            ir_version: int = onnx_graph.ir_version
-            max_ir_version = ir_version if max_ir_version < ir_version else max_ir_version
+    load_onnx_graph = _load_onnx_graph_structure if disable_external_data_load else onnx.load
+
+    # Reading, parsing, copying, cleaning up and prefixing the models is independent per model,
+    # so overlap them. map() keeps the results in the same order as the inputs.
+    def load_and_prepare(model_idx: int, onnx_graph_or_path: Union[onnx.ModelProto, str]):
+        if isinstance(onnx_graph_or_path, onnx.ModelProto):
+            onnx_graph = onnx_graph_or_path
+            if op_prefixes_after_merging:
+                # gs.export_onnx writes the prefixed names back into the TensorProtos of the initializers,
+                # so never hand the caller's ModelProto to onnx_graphsurgeon
+                tmp_onnx_graph = onnx.ModelProto()
+                tmp_onnx_graph.CopyFrom(onnx_graph)
+                onnx_graph = tmp_onnx_graph
+        else:
+            onnx_graph = load_onnx_graph(onnx_graph_or_path)
+        # Collected before the cleanup, which may drop custom domain nodes
+        graph_custom_domains = [
+            (node.name, node.domain) \
+                for node in onnx_graph.graph.node \
+                    if node.domain not in ONNX_STANDARD_DOMAINS
+        ]
+        ir_version: int = onnx_graph.ir_version
+        if cleanup_input_graphs:
+            gs_graph = _cleanup_onnx_graph(onnx_graph)
+        else:
             gs_graph = gs.import_onnx(onnx_graph)
-            gs_graph.cleanup().toposort()
-            tmp_onnx_graphs.append(gs.export_onnx(gs_graph, do_type_check=False, **{'domain': domain, 'ir_version': ir_version}))
-            custom_domain_check_onnx_nodes = \
-                custom_domain_check_onnx_nodes + \
-                    [
-                        node for node in onnx_graph.graph.node \
-                            if node.domain not in ONNX_STANDARD_DOMAINS
-                    ]
-    else:
-        for onnx_path in input_onnx_file_paths:
-            onnx_graph = onnx.load(onnx_path)
-            domain: str = onnx_graph.domain
-            ir_version: int = onnx_graph.ir_version
+        del onnx_graph
+
+        ## 2. Add prefixes
+        # Every model is prefixed exactly once, right after loading, and independently of the others.
+        # The names are edited on the graph-surgeon objects, so the ModelProtos are not rewritten here.
+        # The merge loop below only applies the prefixes to the names in srcop_destop.
+        if op_prefixes_after_merging:
+            _apply_prefix_inplace(gs_graph, f'{op_prefixes_after_merging[model_idx]}_')
+        return gs_graph, ir_version, graph_custom_domains
+
+    onnx_graphs_or_paths = onnx_graphs if len(onnx_graphs) > 0 else input_onnx_file_paths
+    with ThreadPoolExecutor(max_workers=min(len(onnx_graphs_or_paths), os.cpu_count() or 1)) as executor:
+        for gs_graph, ir_version, graph_custom_domains in \
+            executor.map(load_and_prepare, range(len(onnx_graphs_or_paths)), onnx_graphs_or_paths):
+            custom_domains.update(graph_custom_domains)
             max_ir_version = ir_version if max_ir_version < ir_version else max_ir_version
-            gs_graph = gs.import_onnx(onnx_graph)
-            gs_graph.cleanup().toposort()
-            tmp_onnx_graphs.append(gs.export_onnx(gs_graph, do_type_check=False, **{'domain': domain, 'ir_version': ir_version}))
-            custom_domain_check_onnx_graph = onnx.load(onnx_path)
-            custom_domain_check_onnx_nodes = \
-                custom_domain_check_onnx_nodes + \
-                    [
-                        node for node in custom_domain_check_onnx_graph.graph.node \
-                            if node.domain not in ONNX_STANDARD_DOMAINS
-                    ]
-
-    ## 2. Repeat Merge
+            tmp_onnx_graphs.append(gs_graph)
+
+    ## 3. Repeat Merge
+    output_onnx_file_base, output_onnx_file_ext = os.path.splitext(output_onnx_file_path)
+    prefixes_keep_op_names_distinct = bool(op_prefixes_after_merging) and not any(
+        f'{other_prefix}_'.startswith(f'{op_prefix}_') \
+            for op_prefix, other_prefix in itertools.permutations(op_prefixes_after_merging, 2)
+    )
+    check_duplicate_op_names = \
+        not prefixes_keep_op_names_distinct or os.environ.get('SNC4ONNX_CHECK_DUP') == '1'
+
+    # The intermediate files are written on a background thread while the next merge runs.
+    # A single worker keeps the writes in order, and each write waits for the previous one.
+    fusion_file_writer = None
+    pending_fusion_file_write: Optional[Future] = None
+    if output_of_onnx_file_in_the_process_of_fusion and output_onnx_file_path:
+        fusion_file_writer = ThreadPoolExecutor(max_workers=1)
+
+    # (src_prefix, dest_prefix) and the prefixed srcop/destop pairs of every merge step.
+    # Only the first src model keeps its own prefix. Later src models are already merged results
+    # whose OP names carry their prefixes.
+    # The names are interned so that repeated lookups of the same OP name share one object
+    prefix_pairs: List[Tuple[str, str]] = []
+    io_maps = []
     for model_idx in range(0, len(tmp_onnx_graphs) - 1):
         src_prefix = ''
         dest_prefix = ''
-
-        if model_idx == 0:
-            src_model = tmp_onnx_graphs[model_idx]
-            dest_model = tmp_onnx_graphs[model_idx+1]
-            if op_prefixes_after_merging:
+        if op_prefixes_after_merging:
+            if model_idx == 0:
                 src_prefix = f'{op_prefixes_after_merging[model_idx]}_'
-                dest_prefix = f'{op_prefixes_after_merging[model_idx+1]}_'
-        else:
-            src_model = combined_model
-            dest_model = tmp_onnx_graphs[model_idx+1]
-            if op_prefixes_after_merging:
-                src_prefix = ''
-                dest_prefix = f'{op_prefixes_after_merging[model_idx+1]}_'
+            dest_prefix = f'{op_prefixes_after_merging[model_idx+1]}_'
+        prefix_pairs.append((src_prefix, dest_prefix))
+        # srcop_destop[model_idx] is a flat [src, dest, src, dest, ...] list,
+        # and zipping one iterator with itself walks it pair by pair without slicing copies
+        srcop_destop_iter = iter(srcop_destop[model_idx])
+        io_maps.append(
+            [
+                (sys.intern(src_prefix + srcop_destop_src), sys.intern(dest_prefix + srcop_destop_dest)) \
+                    for srcop_destop_src, srcop_destop_dest in \
+                        zip(srcop_destop_iter, srcop_destop_iter)
+            ]
+        )
 
-        if op_prefixes_after_merging:
-            src_model = onnx.compose.add_prefix(
-                src_model,
-                prefix=src_prefix
-            )
-            dest_model = onnx.compose.add_prefix(
-                dest_model,
-                prefix=dest_prefix
-            )
+    # The merged graph stays a graph-surgeon graph across all merges.
+    # Only dest models are imported, and the merged graph is only exported
+    # for intermediate files or for an optimization between merges.
+    # Appending sorted dest nodes after sorted src nodes, and pointing dest nodes at src tensors,
+    # keeps the node order valid. So only the new dest graph is checked in each merge,
+    # and the merged graph is sorted only when one of them was not.
+    needs_toposort = False
+    for model_idx in range(0, len(tmp_onnx_graphs) - 1):
+        src_prefix, dest_prefix = prefix_pairs[model_idx]
+        # Drop the references to the graphs being merged,
+        # so that nothing but the merged graph keeps them alive.
+        if model_idx == 0:
+            src_gs_model = tmp_onnx_graphs[model_idx]
+            tmp_onnx_graphs[model_idx] = None
+            needs_toposort = not _is_toposorted(src_gs_model)
+        dest_gs_model = tmp_onnx_graphs[model_idx+1]
+        tmp_onnx_graphs[model_idx+1] = None
+        needs_toposort = needs_toposort or not _is_toposorted(dest_gs_model)
 
-        src_gs_model = gs.import_onnx(src_model)
-        dest_gs_model = gs.import_onnx(dest_model)
-
-        # Merging Domain Lists
-        src_gs_model_domains: List[onnx.OperatorSetIdProto] = src_gs_model.import_domains
-        dest_gs_model_domains: List[onnx.OperatorSetIdProto] = dest_gs_model.import_domains
-        merged_gs_model_domains: List[onnx.OperatorSetIdProto] = src_gs_model_domains
-        distinct_dest_gs_model_domains = [
-            domain \
-                for domain in dest_gs_model_domains \
-                    if domain not in merged_gs_model_domains
-        ]
-        for domain in distinct_dest_gs_model_domains:
-            merged_gs_model_domains.append(domain)
-        src_gs_model.import_domains = merged_gs_model_domains
+        src_nodes_rewired = _merge_two(
+            src_gs_model,
+            dest_gs_model,
+            io_maps[model_idx],
+            check_duplicate_op_names,
+        )
+        needs_toposort = needs_toposort or src_nodes_rewired
+        # Its nodes and tensors now belong to src_gs_model
+        del dest_gs_model
 
         # Check if Graph contains a custom domain (custom module)
         contains_custom_domain = len(
@@ -315,216 +1052,153 @@ def combine(
             ]
         ) > 0
 
-        # Duplicate OP name check
-        src_node_names = [
-            graph_node.name \
-                for graph_node in src_gs_model.nodes
-        ]
-        src_input_names = [
-            graph_input.name \
-                for graph_input in src_gs_model.inputs
-        ]
-        src_output_names = [
-            graph_output.name \
-                for graph_output in src_gs_model.outputs \
-                    if graph_output.name not in src_node_names
-        ]
-        src_model_op_names = src_node_names + src_input_names + src_output_names
-
-        dest_node_names = [
-            graph_node.name \
-                for graph_node in dest_gs_model.nodes
-        ]
-        dest_input_names = [
-            graph_input.name \
-                for graph_input in dest_gs_model.inputs
-        ]
-        dest_output_names = [
-            graph_output.name \
-                for graph_output in dest_gs_model.outputs \
-                    if graph_output.name not in dest_node_names
-        ]
-        dest_model_op_names = dest_node_names + dest_input_names + dest_output_names
-
-        merged_model_op_names = src_model_op_names + dest_model_op_names
-        op_name_count = collections.Counter(merged_model_op_names)
-        dup_msg = ''
-        for op_name, count in op_name_count.items():
-            if count > 1:
-                dup_msg = f'{dup_msg}op_name:{op_name} count:{count}, '
-        dup_msg = dup_msg.rstrip(', ')
-        if dup_msg:
-            print(
-                f'{Color.RED}ERROR:{Color.RESET} '+
-                f'\nThere is a duplicate OP name after merging models.\n' +
-                f'{dup_msg}\n' +
-                f'Avoid duplicate OP names by specifying a prefix in op_prefixes_after_merging.'
-            )
-            sys.exit(1)
-
-        # Transfer all INPUTs, Nodes and OUTPUTs of dest_gs_model to src_gs_model
-        ## INPUTs
-        for dest_gs_model_input in dest_gs_model.inputs:
-            src_gs_model.inputs.append(dest_gs_model_input)
-        ## Nodes
-        for dest_gs_model_node in dest_gs_model.nodes:
-            src_gs_model.nodes.append(dest_gs_model_node)
-        ## OUTPUTs
-        for dest_gs_model_output in dest_gs_model.outputs:
-            src_gs_model.outputs.append(dest_gs_model_output)
-
-
-        # If the OP specified as srcop in io_map_srcop_destop is a graph INPUT,
-        # use onnx_graphsurgeon to merge
-        # Otherwise, use onnx.compose.merge_models for simple merging
-        srcop_names = [
-            f'{src_prefix}{srcop_destop_src}' \
-                for srcop_destop_src in srcop_destop[model_idx][::2]
-        ]
-        destop_names = [
-            f'{dest_prefix}{srcop_destop_dest}' \
-                for srcop_destop_dest in srcop_destop[model_idx][1::2]
-        ]
-        src_gs_model_input_names = [
-            src_gs_model_input.name \
-                for src_gs_model_input in src_gs_model.inputs
-        ]
-
-        for srcop_name, destop_name in zip(srcop_names, destop_names):
-            # Split processing if srcop_name is included or not included in the graph INPUT
-            if srcop_name in src_gs_model_input_names:
-                # Overwrite srcop with destop if srcop_name is included in the graph INPUT
-                for src_gs_model_input in src_gs_model.inputs:
-                    if src_gs_model_input.name == srcop_name:
-                        for src_gs_model_node in src_gs_model.nodes:
-                            for src_inp_idx, src_gs_model_node_input in enumerate(src_gs_model_node.inputs):
-                                if src_gs_model_node_input.name == destop_name:
-                                    src_gs_model_node.inputs[src_inp_idx] = src_gs_model_input
-            else:
-                src_output = None
-                for src_gs_model_node in src_gs_model.nodes:
-                    for src_gs_model_node_output in src_gs_model_node.outputs:
-                        if src_gs_model_node_output.name == srcop_name:
-                            src_output = src_gs_model_node_output
-                            break
-                    else:
-                        continue
-                    break
-                if src_output:
-                    for src_gs_model_node in src_gs_model.nodes:
-                        for inp_idx, src_gs_model_node_input in enumerate(src_gs_model_node.inputs):
-                            if src_gs_model_node_input.name == destop_name:
-                                src_gs_model_node.inputs[inp_idx] = src_output
-                                # Delete from the graph OUTPUT if the Node was specified as the OUTPUT of the graph.
-                                for out_idx, src_gs_model_output in enumerate(src_gs_model.outputs):
-                                    if src_gs_model_output.name == src_output.name:
-                                        del src_gs_model.outputs[out_idx]
-                                        break
-
-        # Delete unused INPUTs
-        input_names = [input.name for input in src_gs_model.inputs]
-        remove_input_names = []
-        for input_name in input_names:
-            used_flg = False
-            for node in src_gs_model.nodes:
-                for input in node.inputs:
-                    if input.name == input_name:
-                        used_flg = True
-                        break
-                else:
-                    continue
-                break
-            if not used_flg:
-                remove_input_names.append(input_name)
-        src_gs_model.inputs = [
-            src_gs_model_input \
-                for src_gs_model_input in src_gs_model.inputs \
-                    if src_gs_model_input.name not in remove_input_names
-        ]
+        is_last_merge = model_idx == len(tmp_onnx_graphs) - 2
+        output_fusion_file = output_of_onnx_file_in_the_process_of_fusion and output_onnx_file_path
+        # Simplify the intermediate result so that the next merge works on a smaller graph.
+        # The last result is simplified in 6. anyway.
+        # Without its external data the model cannot be constant folded.
+        simplify_fusion_result = simplify_between_merges \
+            and not is_last_merge \
+            and not contains_custom_domain \
+            and not disable_onnxsim \
+            and not (disable_external_data_load and len(onnx_graphs) == 0)
+        # The merged graph is cleaned up once after the last merge,
+        # so only an intermediate model that leaves the loop needs it here.
+        if not output_fusion_file and not simplify_fusion_result:
+            continue
 
         # Cleaning
-        src_gs_model.cleanup().toposort()
+        src_gs_model.cleanup()
+        if needs_toposort:
+            src_gs_model.toposort()
+            needs_toposort = False
         combined_model = gs.export_onnx(src_gs_model, do_type_check=False, **{'ir_version': max_ir_version})
+        simplified = False
+        if simplify_fusion_result:
+            try:
+                combined_model = _simplify(combined_model, simplify_backend)
+                simplified = True
+            except Exception as e:
+                log.warning(
+                    'Failed to optimize the fusion result of model %d and model %d.',
+                    model_idx+1, model_idx+2,
+                )
+                log.warning(traceback.format_exc().splitlines()[-1])
 
         ## Output of onnx files in the process of fusion
-        if output_of_onnx_file_in_the_process_of_fusion and output_onnx_file_path:
-            temp_file_path = f'{os.path.splitext(output_onnx_file_path)[0]}_{model_idx+1}{os.path.splitext(output_onnx_file_path)[1]}'
-            onnx.save(
-                combined_model,
-                temp_file_path
-            )
-            if not non_verbose:
-                print(
-                    f'{Color.GREEN}INFO:{Color.RESET} '+
-                    f'Output the fusion result of model {model_idx+1} and model {model_idx+2}. File: {temp_file_path}'
+        if output_fusion_file:
+            temp_file_path = f'{output_onnx_file_base}_{model_idx+1}{output_onnx_file_ext}'
+            if pending_fusion_file_write is not None:
+                pending_fusion_file_write.result()
+            # The worker only gets data that the merge loop never touches again.
+            if disable_external_data_load and len(onnx_graphs) == 0:
+                # The intermediate file must carry its own weights, but the merge goes on without them
+                fusion_model = onnx.ModelProto()
+                fusion_model.CopyFrom(combined_model)
+                pending_fusion_file_write = fusion_file_writer.submit(
+                    _write_fusion_model_with_external_data, fusion_model, temp_file_path,
+                )
+                del fusion_model
+            elif combined_model.ByteSize() > PROTOBUF_MAX_SIZE:
+                # Saving with external data rewrites combined_model itself
+                _write_onnx(combined_model, temp_file_path)
+                pending_fusion_file_write = None
+            else:
+                pending_fusion_file_write = fusion_file_writer.submit(
+                    _write_serialized, combined_model.SerializeToString(), temp_file_path,
                 )
+            log.info(
+                'Output the fusion result of model %d and model %d. File: %s',
+                model_idx+1, model_idx+2, temp_file_path,
+            )
+
+        if simplified:
+            # The next merge continues from the optimized model.
+            # Graph-surgeon nodes and tensors reference each other,
+            # so the replaced graph is only freed by the cycle collector.
+            src_gs_model = gs.import_onnx(combined_model)
+            needs_toposort = not _is_toposorted(src_gs_model)
+            gc.collect()
+        combined_model = None
+    del tmp_onnx_graphs
+
+    if fusion_file_writer is not None:
+        fusion_file_writer.shutdown(wait=True)
+        # Surface a failed write
+        if pending_fusion_file_write is not None:
+            pending_fusion_file_write.result()
 
-    # 3. If the number of INPUTs in the entire graph is reduced to one,
+    # 4. If the number of INPUTs in the entire graph is reduced to one,
     # reassign the name of the INPUT in srcop without prefix
-    gs_combined_model = gs.import_onnx(combined_model)
-    input_names = [input.name for input in gs_combined_model.inputs]
-    if len(input_names) == 1:
-        input_name = input_names[0]
-        for gs_combined_model_node in gs_combined_model.nodes:
-            for gs_combined_model_node_input in gs_combined_model_node.inputs:
-                if gs_combined_model_node_input.name == input_name:
-                    gs_combined_model_node_input.name = re.sub(f'^{src_prefix}', '', gs_combined_model.inputs[0].name)
-                    break
-            else:
-                continue
-            break
-        gs_combined_model_node_input.name = re.sub(f'^{src_prefix}', '', gs_combined_model.inputs[0].name)
+    gs_combined_model = src_gs_model
+    # The graph INPUT is the same tensor object the consuming nodes read, so renaming it is enough
+    if len(gs_combined_model.inputs) == 1:
+        gs_combined_model.inputs[0].name = _remove_prefix(gs_combined_model.inputs[0].name, src_prefix)
 
-    # 4. Remove prefix from all OUTPUT names
+    # 5. Remove prefix from all OUTPUT names
     # However, if there are duplicate names after removing the prefix, skip the process.
-    replaced_output_names = []
-    for gs_combined_model_node_output in gs_combined_model.outputs:
-        tmp_replaced_output_name = re.sub(f'^{src_prefix}', '', gs_combined_model_node_output.name)
-        if tmp_replaced_output_name not in replaced_output_names:
-            gs_combined_model_node_output.name = tmp_replaced_output_name
-            replaced_output_names.append(tmp_replaced_output_name)
-
-    replaced_output_names = []
-    for gs_combined_model_node_output in gs_combined_model.outputs:
-        tmp_replaced_output_name = re.sub(f'^{dest_prefix}', '', gs_combined_model_node_output.name)
-        if tmp_replaced_output_name not in replaced_output_names:
-            gs_combined_model_node_output.name = tmp_replaced_output_name
-            replaced_output_names.append(tmp_replaced_output_name)
-
-    gs_combined_model.cleanup().toposort()
+    for prefix in [src_prefix, dest_prefix]:
+        replaced_output_names = set()
+        for gs_combined_model_node_output in gs_combined_model.outputs:
+            tmp_replaced_output_name = _remove_prefix(gs_combined_model_node_output.name, prefix)
+            if tmp_replaced_output_name not in replaced_output_names:
+                gs_combined_model_node_output.name = tmp_replaced_output_name
+                replaced_output_names.add(tmp_replaced_output_name)
+
+    gs_combined_model.cleanup()
+    if needs_toposort:
+        gs_combined_model.toposort()
     combined_model = gs.export_onnx(gs_combined_model, do_type_check=False, **{'ir_version': max_ir_version})
+    # Free the merged graph before optimizing, so that it does not stay alive next to the optimized model
+    del gs_combined_model, src_gs_model
+    gc.collect()
 
-    ## 4. Optimize
+    # Everything after this point needs the actual weights
+    if disable_external_data_load and len(onnx_graphs) == 0:
+        _load_external_data(combined_model)
+
+    ## 6. Optimize
     try:
         # onnx-simplifier does not support optimization of ONNX files containing custom domains,
         # so skip simplify if it contains custom domains
         if not contains_custom_domain and not disable_onnxsim:
-            combined_model, check = simplify(combined_model)
+            combined_model = _simplify(combined_model, simplify_backend)
     except Exception as e:
-        if not non_verbose:
-            print(
-                f'{Color.YELLOW}WARNING:{Color.RESET} '+
-                'Failed to optimize the combined onnx file.'
-            )
-            tracetxt = traceback.format_exc().splitlines()[-1]
-            print(f'{Color.YELLOW}WARNING:{Color.RESET} {tracetxt}')
+        log.warning('Failed to optimize the combined onnx file.')
+        log.warning(traceback.format_exc().splitlines()[-1])
 
-    ## 5. Restore a node's custom domain
+    ## 7. Restore a node's custom domain
     if contains_custom_domain:
-        combined_model_graph_nodes = combined_model.graph.node
-        for combined_model_graph_node in combined_model_graph_nodes:
-            for custom_domain_check_onnx_node in custom_domain_check_onnx_nodes:
-                if combined_model_graph_node.name == custom_domain_check_onnx_node.name:
-                    combined_model_graph_node.domain = custom_domain_check_onnx_node.domain
+        for combined_model_graph_node in combined_model.graph.node:
+            if combined_model_graph_node.name in custom_domains:
+                combined_model_graph_node.domain = custom_domains[combined_model_graph_node.name]
 
-    ## 6. Final save
+    ## 8. Final save
     if output_onnx_file_path:
-        onnx.save(combined_model, output_onnx_file_path)
+        # A single protobuf cannot exceed 2GB, so larger models always get external data
+        exceeds_protobuf_max_size = \
+            not output_as_external_data and combined_model.ByteSize() > PROTOBUF_MAX_SIZE
+        if exceeds_protobuf_max_size:
+            log.info(
+                'The combined model exceeds 2GB and is saved with external data. File: %s.data',
+                output_onnx_file_path,
+            )
+        if output_as_external_data or exceeds_protobuf_max_size:
+            _save_as_external_data(combined_model, output_onnx_file_path)
+        else:
+            onnx.save(combined_model, output_onnx_file_path)
+        # The cache only holds single-file models
+        if cached_onnx_file_path and not exceeds_protobuf_max_size:
+            # The combined model is already written, so a cache that cannot be used is not fatal
+            try:
+                _store_in_cache(output_onnx_file_path, cached_onnx_file_path)
+            except OSError:
+                log.warning('Failed to store the combined model in the cache. cache_dir: %s', cache_dir)
+                log.warning(traceback.format_exc().splitlines()[-1])
 
-    if not non_verbose:
-        print(f'{Color.GREEN}INFO:{Color.RESET} Finish!')
+    log.info('Finish!')
 
-    # 7. Return
+    # 9. Return
     return combined_model
 
 
@@ -587,7 +1261,9 @@ def main():
         '-dos',
         '--disable_onnxsim',
         action='store_true',
-        help='Suppress the execution of onnxsim on the backend and dare to leave redundant processing.'
+        help=\
+            'Suppress the execution of onnxsim on the backend and dare to leave redundant processing. '+
+            'Also suppresses the onnxruntime and shape_inference backends of simplify_backend.'
     )
     parser.add_argument(
         '-n',
@@ -595,18 +1271,91 @@ def main():
         action='store_true',
         help='Do not show all information logs. Only error logs are displayed.'
     )
+    parser.add_argument(
+        '-oed',
+        '--output_as_external_data',
+        action='store_true',
+        help=\
+            'Save the weights of the combined model in an external data file '+
+            '(<output_onnx_file_path>.data) instead of inside the .onnx file. '+
+            'Models exceeding the 2GB protobuf limit are always saved this way.'
+    )
+    parser.add_argument(
+        '-dedl',
+        '--disable_external_data_load',
+        action='store_true',
+        help=\
+            'Do not read the external data (weights) of the input onnx files while merging. '+
+            'The weights are read just once, after merging, from the original external data files. '+
+            'Reduces the peak memory when combining large models stored with external data.'
+    )
+    parser.add_argument(
+        '-cig',
+        '--cleanup_input_graphs',
+        action='store_true',
+        help=\
+            'Remove unused nodes from each input model and sort it topologically before merging. '+
+            'The merged graph is always cleaned up, so this is only needed when an input model '+
+            'contains dead nodes whose names collide with OP names of another model.'
+    )
+    parser.add_argument(
+        '-cd',
+        '--cache_dir',
+        type=str,
+        default='',
+        help=\
+            'Directory in which combined models are cached. '+
+            'Running the same combination of input files and options again '+
+            'just copies the cached file to output_onnx_file_path.'
+    )
+    parser.add_argument(
+        '-sb',
+        '--simplify_backend',
+        type=str,
+        default='onnxsim',
+        choices=SIMPLIFY_BACKENDS,
+        help=\
+            'Backend used to optimize the combined model. '+
+            '"onnxruntime" applies only the basic graph optimizations of onnxruntime '+
+            '(constant folding, redundant node elimination), which needs much less time and memory '+
+            'than onnxsim on large models. onnxruntime must be installed. '+
+            '"shape_inference" only runs onnx shape inference over the combined model. '+
+            'This is enough when every input model has already been simplified, '+
+            'since merging itself leaves nothing to fold.'
+    )
+    parser.add_argument(
+        '-sbm',
+        '--simplify_between_merges',
+        action='store_true',
+        help=\
+            'When combining three or more models, also optimize each intermediate fusion result '+
+            'with simplify_backend, so that the following merges work on a smaller graph. '+
+            'The OP names specified in the following srcop_destop must survive the optimization. '+
+            'Has no effect together with disable_external_data_load.'
+    )
     args = parser.parse_args()
 
     # Model combine
-    combined_model = combine(
-        srcop_destop=args.srcop_destop,
-        op_prefixes_after_merging=args.op_prefixes_after_merging,
-        input_onnx_file_paths=args.input_onnx_file_paths,
-        output_onnx_file_path=args.output_onnx_file_path,
-        output_of_onnx_file_in_the_process_of_fusion=args.output_of_onnx_file_in_the_process_of_fusion,
-        disable_onnxsim=args.disable_onnxsim,
-        non_verbose=args.non_verbose,
-    )
+    try:
+        combined_model = combine(
+            srcop_destop=args.srcop_destop,
+            op_prefixes_after_merging=args.op_prefixes_after_merging,
+            input_onnx_file_paths=args.input_onnx_file_paths,
+            output_onnx_file_path=args.output_onnx_file_path,
+            output_of_onnx_file_in_the_process_of_fusion=args.output_of_onnx_file_in_the_process_of_fusion,
+            disable_onnxsim=args.disable_onnxsim,
+            non_verbose=args.non_verbose,
+            output_as_external_data=args.output_as_external_data,
+            disable_external_data_load=args.disable_external_data_load,
+            cleanup_input_graphs=args.cleanup_input_graphs,
+            cache_dir=args.cache_dir,
+            simplify_backend=args.simplify_backend,
+            simplify_between_merges=args.simplify_between_merges,
+        )
+    except CombineError as e:
+        for error_message in e.args:
+            logger.error(error_message)
+        sys.exit(1)
 
 
 if __name__ == '__main__':